@@ -1,14 +1,23 @@
 import argparse
 import calendar
+import contextlib
+import hashlib
+import io
+import json
 import os
+import shutil
 import time
 from datetime import date, datetime, timedelta
+from pathlib import Path
 from zoneinfo import ZoneInfo
 
 import polars as pl
+import polars.selectors as cs
 import polars_distance as pld
 from az_pmp_utils import tableau
 
+DETAIL_IDS_PER_FILE = 1000  # prescribers per detail file, keeps each file small enough to read in milliseconds
+
 
 def add_days(n: int, d: date | None = None) -> date:
     """
@@ -25,6 +34,19 @@ def add_days(n: int, d: date | None = None) -> date:
     return d + timedelta(n)
 
 
+def written_dates() -> tuple[date, date]:
+    """
+    get the first and last written dates for the run, the previous month unless using --no-auto-date
+
+    returns:
+        first_of_month, last_of_month
+    """
+    if args.no_auto_date:
+        return args.first_written_date, args.last_written_date
+    last_of_month = add_days(-1, datetime.now(tz=ZoneInfo(os.environ.get('TZ', 'UTC'))).date().replace(day=1))
+    return last_of_month.replace(day=1), last_of_month
+
+
 def filter_vets(lf: pl.LazyFrame) -> pl.LazyFrame:
     """
     filter out veteranarians from the provided lazyframe
@@ -66,12 +88,7 @@ def csv_from_view_id(file_name: str, luid: str, filters: dict | None = None) ->
 def pull_files() -> None:
     """pull the necessary mu files from tableau and write them to the data folder"""
     t_start_pull_files = time.perf_counter()
-    if args.no_auto_date:
-        first_of_month, last_of_month = args.first_written_date, args.last_written_date
-    else:
-        today = datetime.now(tz=ZoneInfo(os.environ.get('TZ', 'UTC'))).date()
-        last_of_month = add_days(-1, today.replace(day=1))
-        first_of_month = last_of_month.replace(day=1)
+    first_of_month, last_of_month = written_dates()
 
     print(f'pulling files using written dates from {first_of_month!s} to {last_of_month!s}...')
 
@@ -122,24 +139,338 @@ def pull_files() -> None:
     print(f'files pulled: {t_elapsed_pull_files:.2f}s')
 
 
-def supplement(final_dispensations: pl.LazyFrame, first_of_month: date, last_of_month: date, results: pl.DataFrame, users_explode: pl.LazyFrame) -> pl.DataFrame:
+def sample_fraction(value: str) -> float:
     """
-    add supplemental information (opi and benzo overlaps, opi to opi naive, etc) to the data
+    argparse type for a sampling fraction
 
     args:
-        final_dispensations: lf with dispensation data
+        value: the value passed on the command line
+
+    returns:
+        the fraction, greater than 0 and at most 1
+
+    raises:
+        argparse.ArgumentTypeError: if the fraction is not greater than 0 and at most 1
+    """
+    fraction = float(value)
+    if not 0 < fraction <= 1:
+        msg = f'{value} is not greater than 0 and at most 1'
+        raise argparse.ArgumentTypeError(msg)
+    return fraction
+
+
+def period_label(first_of_month: date, last_of_month: date) -> str:
+    """
+    build the label identifying the period of a run in the history and detail stores
+
+    args:
+        first_of_month: first date of the period
+        last_of_month: last date of the period
+
+    returns:
+        `YYYY-MM` for a single full month, `YYYY-MM-DD_YYYY-MM-DD` otherwise
+    """
+    last_day = calendar.monthrange(first_of_month.year, first_of_month.month)[1]
+    if first_of_month.day == 1 and last_of_month == first_of_month.replace(day=last_day):
+        return f'{first_of_month:%Y-%m}'
+    return f'{first_of_month.isoformat()}_{last_of_month.isoformat()}'
+
+
+def run_parameters() -> dict:
+    """
+    get the settings that change the results of a run
+
+    returns:
+        dict of setting name to value
+    """
+    return {
+        'ratio': args.ratio, 'partial_ratio': args.partial_ratio, 'days_before': args.days_before,
+        'filter_vets': not args.no_filter_vets, 'supplement': not args.no_supplement, 'overlap_ratio': args.overlap_ratio,
+        'overlap_type': args.overlap_type, 'naive_ratio': args.naive_ratio, 'mme_threshold': args.mme_threshold
+    }
+
+
+def write_history(results: pl.DataFrame, first_of_month: date, last_of_month: date) -> None:
+    """
+    write results to the history store, partitioned by period, run type, and settings, and update the final_id index
+    runs with different settings for the same period are stored side by side, rerunning a period with the same settings replaces that run
+
+    args:
+        results: df with the final results of the run
         first_of_month: first date of the month in question
         last_of_month: last date of the month in question
-        results: df with dispensation and search rates
-        users_explode: lf with user data with one row for each dea number
+    """
+    print('writing results to history...')
+    t_start = time.perf_counter()
+    history_dir = Path(args.history_dir)
+    period = period_label(first_of_month, last_of_month)
+    run_type = 'full' if not args.no_supplement else 'base'
+    parameters = run_parameters()
+    # short hash of the settings so tuning runs sit alongside the production run instead of replacing it
+    params_id = hashlib.sha256(json.dumps(parameters, sort_keys=True).encode()).hexdigest()[:8]
+    partition_dir = history_dir / period / f'{run_type}-{params_id}'
+    partition_dir.mkdir(parents=True, exist_ok=True)
+
+    # sorted by final_id with small row groups so single prescriber queries can skip most of each partition
+    (
+        results
+        .with_columns(
+            pl.lit(period).alias('period'),
+            pl.lit(run_type).alias('run_type'),
+            pl.lit(params_id).alias('params_id'),
+            pl.lit(first_of_month).alias('period_start'),
+            pl.lit(last_of_month).alias('period_end'),
+            *[pl.lit(value).alias(f'param_{name}') for name, value in parameters.items()]
+        )
+        .sort('final_id')
+        .write_parquet(partition_dir / 'results.parquet', statistics=True, row_group_size=10_000)
+    )
+
+    index_path = history_dir / 'index.parquet'
+    index = (
+        results
+        .select(
+            'final_id',
+            pl.col(['specialty_1', 'specialty_2', 'specialty_3']).cast(pl.String),
+            pl.lit(period).alias('period'),
+            pl.lit(run_type).alias('run_type'),
+            pl.lit(params_id).alias('params_id'),
+            pl.lit(first_of_month).alias('period_start')
+        )
+    )
+    if index_path.exists():
+        stored = (
+            pl.read_parquet(index_path)
+            .filter(~((pl.col('period') == period) & (pl.col('run_type') == run_type) & (pl.col('params_id') == params_id)))
+        )
+        index = pl.concat([stored, index], how='vertical_relaxed')
+    index.sort(['final_id', 'period_start']).write_parquet(index_path)
+
+    t_elapsed = time.perf_counter() - t_start
+    print(f'{partition_dir} and {index_path} saved: {t_elapsed:.2f}s')
+
+
+def query_history() -> None:
+    """print the trend for one prescriber or one specialty across all periods in the history store"""
+    history_dir = Path(args.history_dir)
+    index_path = history_dir / 'index.parquet'
+    if not index_path.exists():
+        print(f'no history found at {history_dir}, run mu.py without --no-history first')
+        return
+
+    if args.query_id:
+        predicate = pl.col('final_id') == args.query_id
+        subject = f'final_id {args.query_id}'
+    else:
+        predicate = pl.any_horizontal(pl.col(['specialty_1', 'specialty_2', 'specialty_3']) == args.query_specialty)
+        subject = f'specialty {args.query_specialty}'
+
+    # the index tells us which partitions to read so periods without a match are never scanned
+    partitions = (
+        pl.scan_parquet(index_path)
+        .filter(predicate)
+        .select('period', 'run_type', 'params_id')
+        .unique()
+        .sort(['period', 'run_type', 'params_id'])
+        .collect()
+        .rows()
+    )
+    if not partitions:
+        print(f'no history found for {subject}')
+        return
+
+    trend = (
+        pl.concat(
+            [
+                pl.scan_parquet(history_dir / period / f'{run_type}-{params_id}' / 'results.parquet').filter(predicate)
+                for period, run_type, params_id in partitions
+            ],
+            how='diagonal_relaxed'
+        )
+        .collect()
+    )
+
+    if args.query_specialty:
+        count_cols = cs.by_name(
+            'dispensations', 'searches', 'opi_rx', 'benzo_rx', 'rx_over_mme_threshold',
+            'overlapping_rx_part', 'overlapping_rx_last', 'opi_to_opi_naive', require_all=False
+        )
+        trend = (
+            trend
+            .group_by('period', 'run_type', 'params_id', 'period_start', cs.starts_with('param_'))
+            .agg(pl.len().alias('prescribers'), count_cols.sum())
+            .with_columns(
+                ((pl.col('searches') / pl.col('dispensations')) * 100).round(2).alias('rate')
+            )
+        )
+
+    trend = trend.sort(['period_start', 'run_type', 'params_id']).drop('period_start', 'period_end', strict=False)
+
+    print(f'trend for {subject} across {len({period for period, _, _ in partitions})} period(s):')
+    with pl.Config(tbl_rows=-1, tbl_cols=-1):
+        print(trend)
+
+
+def detail_staging_dir(period: str) -> Path:
+    """
+    get the folder a --detail run writes to before it replaces the period's detail files
+
+    args:
+        period: the period label of the run
 
     returns:
-        results df updated with supplemental information
+        the staging folder for the period
     """
-    print('adding supplemental information...')
-    t_start_sup = time.perf_counter()
+    return Path(args.detail_dir) / f'.{period}.tmp'
 
-    active = (
+
+def publish_detail(period: str) -> None:
+    """
+    replace the period's detail files with the ones written by this run and mark the period as the latest
+
+    args:
+        period: the period label of the run
+    """
+    detail_dir = Path(args.detail_dir)
+    period_dir = detail_dir / period
+    # drops every artifact from an earlier run of the period, including overlap types this run did not write
+    if period_dir.exists():
+        shutil.rmtree(period_dir)
+    detail_staging_dir(period).rename(period_dir)
+    (detail_dir / 'latest').write_text(period)
+    print(f'{period_dir} saved')
+
+
+def write_detail(df: pl.DataFrame, name: str, period: str, key: str = 'final_id') -> None:
+    """
+    write a detail frame as final_id range partitioned parquet files with a lookup index
+    the index holds the file, offset, and length of each final_id's rows so a lookup reads only those rows
+
+    args:
+        df: the materialized frame to write
+        name: the name of the detail artifact, used as the folder name
+        period: the period label of the run
+        key: the column with the final_id to partition and index by
+    """
+    t_start = time.perf_counter()
+    artifact_dir = detail_staging_dir(period) / name
+    artifact_dir.mkdir(parents=True)
+
+    df = (
+        df
+        .filter(pl.col(key).is_not_null())
+        .sort(key)
+        .with_columns(
+            (pl.col(key).rle_id() // DETAIL_IDS_PER_FILE).alias('part')
+        )
+    )
+
+    index = []
+    for (part,), part_df in df.partition_by('part', as_dict=True, maintain_order=True).items():
+        file_name = f'part-{part:05d}.parquet'
+        part_rows = part_df.drop('part')
+        part_rows.write_parquet(artifact_dir / file_name)
+        index.append(
+            part_rows
+            .group_by(key, maintain_order=True)
+            .len(name='length')
+            .with_columns(
+                pl.col('length').cum_sum().shift(1, fill_value=0).alias('offset'),
+                pl.lit(file_name).alias('file')
+            )
+            .select(pl.col(key).cast(pl.String).alias('final_id'), 'file', 'offset', 'length')
+        )
+
+    if index:
+        pl.concat(index).write_parquet(artifact_dir / 'index.parquet')
+    else:
+        pl.DataFrame(schema={'final_id': pl.String, 'file': pl.String, 'offset': pl.UInt32, 'length': pl.UInt32}).write_parquet(artifact_dir / 'index.parquet')
+
+    t_elapsed = time.perf_counter() - t_start
+    print(f'{artifact_dir} saved: {t_elapsed:.2f}s')
+
+
+def write_search_detail(final_dispensations: pl.LazyFrame, matched_searches: pl.LazyFrame, period: str) -> None:
+    """
+    start the detail files for a run with the dispensations and matched searches, clearing any unfinished earlier run
+
+    args:
+        final_dispensations: lf with searches matched to dispensations, materialized in check_for_searches
+        matched_searches: lf with each search matched to a dispensation, materialized in check_for_searches
+        period: the period label of the run
+    """
+    print('writing search detail files...')
+    t_start = time.perf_counter()
+    staging_dir = detail_staging_dir(period)
+    if staging_dir.exists():
+        shutil.rmtree(staging_dir)
+    # both were materialized in check_for_searches, so these collects do not rerun the search join
+    write_detail(final_dispensations.collect(), 'dispensations', period)
+    write_detail(matched_searches.collect(), 'searches', period)
+    t_elapsed = time.perf_counter() - t_start
+    print(f'search detail files written: {t_elapsed:.2f}s')
+
+
+def overlap_detail(overlap_active: pl.DataFrame) -> pl.DataFrame:
+    """
+    list each overlap under both the benzo and the opioid prescriber for the detail files
+
+    args:
+        overlap_active: df with overlapping benzo and opioid rx
+
+    returns:
+        the overlaps with a `lookup_id` column holding the final_id each row is listed under
+    """
+    return pl.concat([
+        overlap_active.with_columns(pl.col('final_id').alias('lookup_id')),
+        (
+            overlap_active
+            .filter(pl.col('final_id_opi') != pl.col('final_id'))
+            .with_columns(pl.col('final_id_opi').alias('lookup_id'))
+        )
+    ])
+
+
+def lookup_detail() -> None:
+    """print one prescriber's results, dispensations, matched searches, and overlaps from the detail files"""
+    detail_dir = Path(args.detail_dir)
+    latest_path = detail_dir / 'latest'
+    if args.lookup_period:
+        period = args.lookup_period
+    elif latest_path.exists():
+        period = latest_path.read_text().strip()
+    else:
+        print(f'no detail files found at {detail_dir}, run mu.py with --detail first')
+        return
+
+    period_dir = detail_dir / period
+    if not period_dir.is_dir():
+        print(f'no detail files found at {period_dir}, run mu.py with --detail first')
+        return
+
+    print(f'detail for final_id {args.lookup_id} in {period_dir.name}:')
+    with pl.Config(tbl_rows=-1, tbl_cols=-1):
+        for artifact_dir in sorted(p for p in period_dir.iterdir() if (p / 'index.parquet').exists()):
+            locations = (
+                pl.read_parquet(artifact_dir / 'index.parquet')
+                .filter(pl.col('final_id') == args.lookup_id)
+            )
+            rows = [
+                pl.scan_parquet(artifact_dir / file).slice(offset, length).collect()
+                for file, offset, length in locations.select('file', 'offset', 'length').iter_rows()
+            ]
+            print(f'{artifact_dir.name}:')
+            print(pl.concat(rows) if rows else 'none')
+
+
+def scan_active() -> pl.LazyFrame:
+    """
+    scan the active rx file with renamed columns, before the users join
+
+    returns:
+        the active rx lazyframe
+    """
+    return (
         pl.scan_csv('data/active_rx_data.csv', infer_schema_length=10000)
         .rename({
             'Month, Day, Year of Patient Birthdate': 'dob', 'Month, Day, Year of Filled At': 'filled_date',
@@ -147,6 +478,21 @@ def supplement(final_dispensations: pl.LazyFrame, first_of_month: date, last_of_
             'Orig Patient First Name': 'patient_first_name', 'Orig Patient Last Name': 'patient_last_name', 'Prescriber DEA': 'dea',
             'AHFS Description': 'ahfs', 'Month, Day, Year of rx_end': 'rx_end', 'Animal Name': 'animal_name'
         })
+    )
+
+
+def prep_supplement_files(users_explode: pl.LazyFrame) -> tuple[pl.LazyFrame, pl.LazyFrame, pl.LazyFrame]:
+    """
+    prep the supplement input files for analysis
+
+    args:
+        users_explode: lf with user data with one row for each dea number
+
+    returns:
+        benzo_active, opi_active, naive lazyframes
+    """
+    active = (
+        scan_active()
         .join(users_explode, how='left', left_on='dea', right_on='dea_number', coalesce=True)
         .with_columns(
             pl.col(['filled_date', 'create_date', 'written_date', 'rx_end', 'dob']).str.to_date('%B %d, %Y'),
@@ -171,6 +517,76 @@ def supplement(final_dispensations: pl.LazyFrame, first_of_month: date, last_of_
             pl.col('ahfs').str.contains('OPIOID')
         )
     )
+
+    naive = (
+        pl.scan_csv('data/naive_rx_data.csv', infer_schema_length=10000)
+        .rename({
+            'Orig Patient First Name': 'patient_first_name', 'Orig Patient Last Name': 'patient_last_name', 'Max. naive_end': 'naive_end',
+            'Month, Day, Year of Patient Birthdate': 'dob', 'Month, Day, Year of Filled At': 'naive_filled_date', 'Animal Name': 'animal_name'
+        })
+        .with_columns(
+            pl.col(['dob', 'naive_filled_date']).str.to_date('%B %-d, %Y'),
+            pl.col('naive_end').str.to_date('%-m/%-d/%Y'),
+            (pl.col('patient_first_name') + ' ' + pl.col('patient_last_name')).str.to_uppercase().alias('naive_patient_name')
+        )
+        .drop('patient_first_name', 'patient_last_name')
+    )
+
+    naive = filter_vets(naive)
+
+    return benzo_active, opi_active, naive
+
+
+def naive_dispensations(final_dispensations: pl.LazyFrame, naive: pl.LazyFrame) -> pl.LazyFrame:
+    """
+    find the opioid dispensations written to patients who were not opioid naive
+
+    args:
+        final_dispensations: lf with dispensation data
+        naive: lf with opioid rx that were active in the naive window
+
+    returns:
+        lf with one row per final_id and rx_number that was not opioid naive
+    """
+    return (
+        final_dispensations
+        .lazy()
+        .filter(pl.col('ahfs').str.contains('OPIOID'))
+        .join(naive, how='left', left_on='disp_dob', right_on='dob', coalesce=True)
+        .filter(
+            pl.col('written_date').is_between(pl.col('naive_filled_date'), pl.col('naive_end'))
+        )
+        .with_columns(
+            (1 - pld.col('naive_patient_name').dist_str.jaro_winkler('patient_name')).alias('ratio')
+        )
+        .filter(
+            pl.col('ratio') >= args.naive_ratio
+        )
+        .with_columns(
+            pl.lit(False).alias('opi_naive')  # noqa: FBT003 | setting col values to False
+        )
+        .unique(subset=['final_id', 'rx_number'])
+    )
+
+
+def supplement(final_dispensations: pl.LazyFrame, first_of_month: date, last_of_month: date, results: pl.DataFrame, users_explode: pl.LazyFrame) -> pl.DataFrame:
+    """
+    add supplemental information (opi and benzo overlaps, opi to opi naive, etc) to the data
+
+    args:
+        final_dispensations: lf with dispensation data
+        first_of_month: first date of the month in question
+        last_of_month: last date of the month in question
+        results: df with dispensation and search rates
+        users_explode: lf with user data with one row for each dea number
+
+    returns:
+        results df updated with supplemental information
+    """
+    print('adding supplemental information...')
+    t_start_sup = time.perf_counter()
+
+    benzo_active, opi_active, naive = prep_supplement_files(users_explode)
     t_elapsed = time.perf_counter() - t_start_sup
     print(f'supplemental files prep complete: {t_elapsed:.2f}s')
 
@@ -193,8 +609,8 @@ def supplement(final_dispensations: pl.LazyFrame, first_of_month: date, last_of_
             .collect(engine='streaming')
         )
 
-        if args.testing:
-            overlap_active.write_csv('overlaps_part.csv')
+        if args.detail:
+            write_detail(overlap_detail(overlap_active), 'overlaps_part', period_label(first_of_month, last_of_month), key='lookup_id')
 
         benzo_dispensations_overlap = (
             overlap_active
@@ -253,8 +669,8 @@ def supplement(final_dispensations: pl.LazyFrame, first_of_month: date, last_of_
             .collect(engine='streaming')
         )
 
-        if args.testing:
-            overlap_active.write_csv('overlaps_last.csv')
+        if args.detail:
+            write_detail(overlap_detail(overlap_active), 'overlaps_last', period_label(first_of_month, last_of_month), key='lookup_id')
 
         benzo_dispensations_overlap = (
             overlap_active
@@ -301,41 +717,7 @@ def supplement(final_dispensations: pl.LazyFrame, first_of_month: date, last_of_
 
     print('processing opioid naive...')
     t_start = time.perf_counter()
-    naive = (
-        pl.scan_csv('data/naive_rx_data.csv', infer_schema_length=10000)
-        .rename({
-            'Orig Patient First Name': 'patient_first_name', 'Orig Patient Last Name': 'patient_last_name', 'Max. naive_end': 'naive_end',
-            'Month, Day, Year of Patient Birthdate': 'dob', 'Month, Day, Year of Filled At': 'naive_filled_date', 'Animal Name': 'animal_name'
-        })
-        .with_columns(
-            pl.col(['dob', 'naive_filled_date']).str.to_date('%B %-d, %Y'),
-            pl.col('naive_end').str.to_date('%-m/%-d/%Y'),
-            (pl.col('patient_first_name') + ' ' + pl.col('patient_last_name')).str.to_uppercase().alias('naive_patient_name')
-        )
-        .drop('patient_first_name', 'patient_last_name')
-    )
-
-    naive = filter_vets(naive)
-
-    naive_disps = (
-        final_dispensations
-        .lazy()
-        .filter(pl.col('ahfs').str.contains('OPIOID'))
-        .join(naive, how='left', left_on='disp_dob', right_on='dob', coalesce=True)
-        .filter(
-            pl.col('written_date').is_between(pl.col('naive_filled_date'), pl.col('naive_end'))
-        )
-        .with_columns(
-            (1 - pld.col('naive_patient_name').dist_str.jaro_winkler('patient_name')).alias('ratio')
-        )
-        .filter(
-            pl.col('ratio') >= args.naive_ratio
-        )
-        .with_columns(
-            pl.lit(False).alias('opi_naive')  # noqa: FBT003 | setting col values to False
-        )
-        .unique(subset=['final_id', 'rx_number'])
-    )
+    naive_disps = naive_dispensations(final_dispensations, naive)
 
     naive_disps = (
         final_dispensations
@@ -370,6 +752,34 @@ def supplement(final_dispensations: pl.LazyFrame, first_of_month: date, last_of_
     return results
 
 
+def scan_dispensations() -> pl.LazyFrame:
+    """
+    scan the dispensations file with renamed columns and valid prescriber deas, before the users join
+
+    returns:
+        the dispensations lazyframe
+    """
+    pattern = r'^[A-Za-z]{2}\d{7}$'  # 2 letters followed by 7 digits
+    return (
+        pl.scan_csv('data/dispensations_data.csv', infer_schema_length=10000)
+        .rename({'Month, Day, Year of Patient Birthdate': 'disp_dob', 'Month, Day, Year of Written At': 'written_date',
+                 'Month, Day, Year of Filled At': 'filled_date', 'Month, Day, Year of Dispensations Created At': 'disp_created_date',
+                 'Prescriber First Name': 'prescriber_first_name', 'Prescriber Last Name': 'prescriber_last_name',
+                 'Orig Patient First Name': 'patient_first_name', 'Orig Patient Last Name': 'patient_last_name',
+                 'Prescriber DEA': 'prescriber_dea', 'Generic Name': 'generic_name', 'Prescription Number': 'rx_number',
+                 'AHFS Description': 'ahfs', 'Daily MME': 'mme', 'Days Supply': 'days_supply', 'Animal Name': 'animal_name'})
+        .with_columns(
+            pl.col(['disp_dob', 'written_date', 'filled_date', 'disp_created_date']).str.to_date('%B %d, %Y'),
+            pl.col('prescriber_dea').str.to_uppercase().str.strip_chars(),
+            (pl.col('patient_first_name') + ' ' + pl.col('patient_last_name')).str.to_uppercase().alias('patient_name'),
+            (pl.col('prescriber_first_name') + ' ' + pl.col('prescriber_last_name')).str.to_uppercase().alias('prescriber_name')
+        )
+        .filter(
+            pl.col('prescriber_dea').str.contains(pattern)
+        )
+    )
+
+
 def prep_files(first_of_month: date, last_of_month: date) -> tuple[pl.LazyFrame, pl.LazyFrame, pl.LazyFrame, pl.LazyFrame]:
     """
     prep the input files for analysis
@@ -404,24 +814,8 @@ def prep_files(first_of_month: date, last_of_month: date) -> tuple[pl.LazyFrame,
         )
     )
 
-    pattern = r'^[A-Za-z]{2}\d{7}$'  # 2 letters followed by 7 digits
     dispensations = (
-        pl.scan_csv('data/dispensations_data.csv', infer_schema_length=10000)
-        .rename({'Month, Day, Year of Patient Birthdate': 'disp_dob', 'Month, Day, Year of Written At': 'written_date',
-                 'Month, Day, Year of Filled At': 'filled_date', 'Month, Day, Year of Dispensations Created At': 'disp_created_date',
-                 'Prescriber First Name': 'prescriber_first_name', 'Prescriber Last Name': 'prescriber_last_name',
-                 'Orig Patient First Name': 'patient_first_name', 'Orig Patient Last Name': 'patient_last_name',
-                 'Prescriber DEA': 'prescriber_dea', 'Generic Name': 'generic_name', 'Prescription Number': 'rx_number',
-                 'AHFS Description': 'ahfs', 'Daily MME': 'mme', 'Days Supply': 'days_supply', 'Animal Name': 'animal_name'})
-        .with_columns(
-            pl.col(['disp_dob', 'written_date', 'filled_date', 'disp_created_date']).str.to_date('%B %d, %Y'),
-            pl.col('prescriber_dea').str.to_uppercase().str.strip_chars(),
-            (pl.col('patient_first_name') + ' ' + pl.col('patient_last_name')).str.to_uppercase().alias('patient_name'),
-            (pl.col('prescriber_first_name') + ' ' + pl.col('prescriber_last_name')).str.to_uppercase().alias('prescriber_name')
-        )
-        .filter(
-            pl.col('prescriber_dea').str.contains(pattern)
-        )
+        scan_dispensations()
         .join(users_explode, how='left', left_on='prescriber_dea', right_on='dea_number', coalesce=True)
         .with_columns(
             (pl.col('written_date').dt.offset_by(f'-{args.days_before}d')).alias('start_date'),
@@ -461,7 +855,32 @@ def prep_files(first_of_month: date, last_of_month: date) -> tuple[pl.LazyFrame,
     return dispensations, searches, users, users_explode
 
 
-def check_for_searches(dispensations: pl.LazyFrame, searches: pl.LazyFrame, users: pl.LazyFrame) -> tuple[pl.LazyFrame, pl.LazyFrame]:
+def prescriber_summary(final_dispensations: pl.LazyFrame) -> pl.LazyFrame:
+    """
+    count dispensations and searches by prescriber, with the keys for joining user and dea information
+
+    args:
+        final_dispensations: a lazyframe with searches matched to dispensations
+
+    returns:
+        lf with one row per final_id
+    """
+    pattern_cap = r'^([A-Za-z]{2}\d{7})$'  # 2 letters followed by 7 digits
+    return (
+        final_dispensations
+        .group_by(['final_id'])
+        .agg([pl.len(), pl.col('search').sum()])
+        .with_columns(
+            ((pl.col('search') / pl.col('len')) * 100).alias('rate'),
+            (pl.col('final_id').str.to_integer(base=10, strict=False).cast(pl.Int64)).alias('true_id'),
+            (pl.col('final_id').str.extract(pattern_cap)).alias('unreg_dea')
+        )
+        .rename({'len': 'dispensations', 'search': 'searches'})
+        .lazy()
+    )
+
+
+def check_for_searches(dispensations: pl.LazyFrame, searches: pl.LazyFrame, users: pl.LazyFrame) -> tuple[pl.LazyFrame, pl.LazyFrame, pl.LazyFrame]:
     """
     checks the dispenations lazyframe for corresponding searches
 
@@ -471,11 +890,11 @@ def check_for_searches(dispensations: pl.LazyFrame, searches: pl.LazyFrame, user
         users: a lazyframe with user information
 
     returns:
-        final_dispensations, results lazyframes
+        final_dispensations, results, matched_searches lazyframes
     """
     print('checking dispensations for searches...')
     t_start = time.perf_counter()
-    dispensations_with_searches = (
+    matched_searches = (
         dispensations
         .join(searches, how='left', on='true_id', coalesce=True)
         .filter(
@@ -488,6 +907,20 @@ def check_for_searches(dispensations: pl.LazyFrame, searches: pl.LazyFrame, user
         .filter(
             pl.col('ratio') >= pl.col('ratio_check')
         )
+        .with_columns(
+            pl.col('true_id').fill_null(pl.col('prescriber_dea')).alias('final_id')
+        )
+        .select(
+            'final_id', 'rx_number', 'prescriber_dea', 'written_date', 'patient_name', 'disp_dob',
+            'created_date', 'full_name', 'search_dob', 'partial', 'ratio', 'ratio_check'
+        )
+    )
+    if args.detail:
+        # collected once so final_dispensations and the detail files share a single run of the search join
+        matched_searches = matched_searches.collect(engine='streaming').lazy()
+
+    dispensations_with_searches = (
+        matched_searches
         .unique(subset=['rx_number', 'prescriber_dea', 'written_date'])
         .select('rx_number', 'prescriber_dea', 'written_date')
         .with_columns(
@@ -504,20 +937,13 @@ def check_for_searches(dispensations: pl.LazyFrame, searches: pl.LazyFrame, user
             pl.col('true_id').fill_null(pl.col('prescriber_dea')).alias('final_id')
         )
     )
+    if args.detail:
+        # collected once so results, the counts, supplement, and the detail files all reuse it
+        final_dispensations = final_dispensations.collect(engine='streaming').lazy()
 
-    pattern_cap = r'^([A-Za-z]{2}\d{7})$'  # 2 letters followed by 7 digits
     deas = dispensations.select('prescriber_dea', 'prescriber_name').lazy()
     results = (
-        final_dispensations
-        .group_by(['final_id'])
-        .agg([pl.len(), pl.col('search').sum()])
-        .with_columns(
-            ((pl.col('search') / pl.col('len')) * 100).alias('rate'),
-            (pl.col('final_id').str.to_integer(base=10, strict=False).cast(pl.Int64)).alias('true_id'),
-            (pl.col('final_id').str.extract(pattern_cap)).alias('unreg_dea')
-        )
-        .rename({'len': 'dispensations', 'search': 'searches'})
-        .lazy()
+        prescriber_summary(final_dispensations)
         .join(users, how='left', on='true_id', coalesce=True)
         .join(deas, how='left', left_on='unreg_dea', right_on='prescriber_dea', coalesce=True)
         .unique('final_id')
@@ -535,7 +961,7 @@ def check_for_searches(dispensations: pl.LazyFrame, searches: pl.LazyFrame, user
     )
     t_elapsed = time.perf_counter() - t_start
     print(f'dispensations checked for searches: {t_elapsed:.2f}s')
-    return final_dispensations, results
+    return final_dispensations, results, matched_searches
 
 
 def add_counts(final_dispensations: pl.LazyFrame, results: pl.LazyFrame) -> pl.DataFrame:
@@ -629,29 +1055,260 @@ def add_counts(final_dispensations: pl.LazyFrame, results: pl.LazyFrame) -> pl.D
     return new_results
 
 
+def explain_step() -> int:
+    """
+    get the sampling step for --explain
+
+    returns:
+        keep 1 in this many rows for sampled join estimates
+    """
+    return round(1 / args.explain_sample)
+
+
+def estimate_join(name: str, left: pl.LazyFrame, right: pl.LazyFrame, keys: tuple[str | list[str], str | list[str]], *, presampled: bool = False) -> dict:
+    """
+    estimate the output rows of a left join from a sample of the left join keys
+    the right key counts are taken in full so the join itself is never materialized
+
+    args:
+        name: the name of the join for the report
+        left: the left lazyframe of the join
+        right: the right lazyframe of the join
+        keys: the join key(s) in `left` and in `right`
+        presampled: `left` and `right` were built from the same sample of dispensations, for joins whose right side is derived from the left
+
+    returns:
+        dict with the join name, input row counts, estimated output rows, and fan-out
+    """
+    t_start = time.perf_counter()
+    step = explain_step()
+    left_on, right_on = keys
+    # presampled inputs are scaled back up so every row of the report is in full data terms
+    scale = step if presampled else 1
+    left_sample = left if presampled else left.gather_every(step)
+    left_rows = left.select(pl.len()).collect(engine='streaming').item() * scale
+    right_rows = right.select(pl.len()).collect(engine='streaming').item() * scale
+
+    right_counts = right.group_by(right_on).len(name='right_n')
+    sampled_rows = (
+        left_sample
+        .select(left_on)
+        .group_by(left_on)
+        .len(name='left_n')
+        .join(right_counts, how='left', left_on=left_on, right_on=right_on)
+        # unmatched left rows are kept by a left join so they count once
+        .select((pl.col('left_n').cast(pl.UInt64) * pl.col('right_n').cast(pl.UInt64).fill_null(1)).sum())
+        .collect(engine='streaming')
+        .item()
+    )
+    est_rows = (sampled_rows or 0) * step
+
+    t_elapsed = time.perf_counter() - t_start
+    print(f'{name} estimated: {t_elapsed:.2f}s')
+    return {
+        'join': name, 'left_rows': left_rows, 'right_rows': right_rows, 'est_rows': est_rows,
+        'fan_out': est_rows / left_rows if left_rows else 0.0
+    }
+
+
+def print_plans(dispensations: pl.LazyFrame, searches: pl.LazyFrame, users: pl.LazyFrame, users_explode: pl.LazyFrame) -> None:
+    """
+    print the optimized plan for each stage of mu
+
+    args:
+        dispensations: a lazyframe with all of the dispensations in question
+        searches: a lazyframe with all searches performed in the relevant timeframe
+        users: a lazyframe with user information
+        users_explode: lf with user data with one row for each dea number
+    """
+    final_dispensations, results, matched_searches = check_for_searches(dispensations, searches, users)
+
+    stages = {
+        'users_explode': users_explode, 'dispensations': dispensations, 'searches': searches,
+        'matched_searches': matched_searches, 'final_dispensations': final_dispensations, 'results': results
+    }
+    if not args.no_supplement:
+        benzo_active, opi_active, naive = prep_supplement_files(users_explode)
+        stages |= {'benzo_active': benzo_active, 'opi_active': opi_active, 'naive': naive}
+
+    for name, lf in stages.items():
+        print(f'--- {name} optimized plan ---')
+        print(lf.explain())
+
+
+def sample_search_stage(dispensations: pl.LazyFrame, searches: pl.LazyFrame, users: pl.LazyFrame) -> tuple[pl.LazyFrame, pl.LazyFrame, pl.LazyFrame]:
+    """
+    run check_for_searches on a sample of dispensations for the joins whose right side is built from the left
+    the outputs are collected once so each estimate reads them instead of rerunning the sampled search join
+
+    args:
+        dispensations: a lazyframe with all of the dispensations in question
+        searches: a lazyframe with all searches performed in the relevant timeframe
+        users: a lazyframe with user information
+
+    returns:
+        sample_dispensations, sample_final_dispensations, sample_dispensations_with_searches lazyframes
+    """
+    step = explain_step()
+    print(f'running check_for_searches on 1 in {step} dispensations...')
+    t_start = time.perf_counter()
+    sample_dispensations = dispensations.gather_every(step).collect(engine='streaming').lazy()
+    # check_for_searches only builds the lazy plan here, its progress messages would read like a real run
+    with contextlib.redirect_stdout(io.StringIO()):
+        sample_final_dispensations, _sample_results, sample_matched_searches = check_for_searches(sample_dispensations, searches, users)
+    sample_final_df, sample_matched_df = pl.collect_all([sample_final_dispensations, sample_matched_searches], engine='streaming')
+    sample_dispensations_with_searches = (
+        sample_matched_df
+        .unique(subset=['rx_number', 'prescriber_dea', 'written_date'])
+        .select('rx_number', 'prescriber_dea', 'written_date')
+    )
+    t_elapsed = time.perf_counter() - t_start
+    print(f'sampled check_for_searches complete: {t_elapsed:.2f}s')
+    return sample_dispensations, sample_final_df.lazy(), sample_dispensations_with_searches.lazy()
+
+
+def search_join_estimates(dispensations: pl.LazyFrame, searches: pl.LazyFrame, users: pl.LazyFrame, users_explode: pl.LazyFrame) -> tuple[list[dict], pl.LazyFrame]:
+    """
+    estimate the joins in prep_files and check_for_searches
+
+    args:
+        dispensations: a lazyframe with all of the dispensations in question
+        searches: a lazyframe with all searches performed in the relevant timeframe
+        users: a lazyframe with user information
+        users_explode: lf with user data with one row for each dea number
+
+    returns:
+        the estimates, and the sampled final_dispensations for the supplement estimates
+    """
+    sample_dispensations, sample_final_dispensations, sample_dispensations_with_searches = sample_search_stage(dispensations, searches, users)
+
+    # the same final_ids as final_dispensations without running the search join, the search flags do not change the join keys
+    prescribers = prescriber_summary(
+        dispensations
+        .unique(subset=['rx_number', 'prescriber_dea', 'written_date'])
+        .with_columns(
+            pl.col('true_id').fill_null(pl.col('prescriber_dea')).alias('final_id'),
+            pl.lit(False).alias('search')  # noqa: FBT003 | setting col values to False
+        )
+    )
+    deas = dispensations.select('prescriber_dea', 'prescriber_name')
+
+    users_rows = users.select(pl.len()).collect().item()
+    users_explode_rows = users_explode.select(pl.len()).collect().item()
+    rx_keys = ['rx_number', 'prescriber_dea', 'written_date']
+    estimates = [
+        # not a join, the row fan-out from splitting each user's dea numbers into their own rows
+        {
+            'join': 'prep_files users explode', 'left_rows': users_rows, 'right_rows': None, 'est_rows': users_explode_rows,
+            'fan_out': users_explode_rows / users_rows if users_rows else 0.0
+        },
+        estimate_join('prep_files dea_number', scan_dispensations(), users_explode, ('prescriber_dea', 'dea_number')),
+        estimate_join('check_for_searches true_id', dispensations, searches, ('true_id', 'true_id')),
+        estimate_join(
+            'check_for_searches search flags', sample_dispensations, sample_dispensations_with_searches, (rx_keys, rx_keys), presampled=True
+        ),
+        estimate_join('check_for_searches users true_id', prescribers, users, ('true_id', 'true_id')),
+        estimate_join('check_for_searches unreg_dea', prescribers, deas, ('unreg_dea', 'prescriber_dea')),
+    ]
+    return estimates, sample_final_dispensations
+
+
+def supplement_join_estimates(users_explode: pl.LazyFrame, sample_final_dispensations: pl.LazyFrame) -> list[dict]:
+    """
+    estimate the joins in supplement
+
+    args:
+        users_explode: lf with user data with one row for each dea number
+        sample_final_dispensations: collected final_dispensations for the sample of dispensations
+
+    returns:
+        the estimates
+    """
+    benzo_active, opi_active, naive = prep_supplement_files(users_explode)
+    sample_opi_dispensations = sample_final_dispensations.filter(pl.col('ahfs').str.contains('OPIOID'))
+    # collected once so the estimate reads it instead of rerunning the sampled naive join
+    sample_naive_disps = naive_dispensations(sample_final_dispensations, naive).collect(engine='streaming').lazy()
+    naive_keys = ['final_id', 'rx_number']
+    return [
+        estimate_join('supplement active dea_number', scan_active(), users_explode, ('dea', 'dea_number')),
+        estimate_join('supplement overlap dob', benzo_active, opi_active, ('dob', 'dob')),
+        estimate_join('supplement naive dob', sample_opi_dispensations, naive, ('disp_dob', 'dob'), presampled=True),
+        estimate_join('supplement naive flags', sample_final_dispensations, sample_naive_disps, (naive_keys, naive_keys), presampled=True),
+    ]
+
+
+def explain() -> None:
+    """print the optimized plan for each stage and a sampled cardinality estimate for each join instead of running mu"""
+    t_start_explain = time.perf_counter()
+    first_of_month, last_of_month = written_dates()
+
+    dispensations, searches, users, users_explode = prep_files(first_of_month, last_of_month)
+    print_plans(dispensations, searches, users, users_explode)
+
+    print('estimating join cardinality...')
+    estimates, sample_final_dispensations = search_join_estimates(dispensations, searches, users, users_explode)
+    if not args.no_supplement:
+        estimates += supplement_join_estimates(users_explode, sample_final_dispensations)
+
+    report = (
+        pl.DataFrame(estimates)
+        .with_columns(
+            pl.col('fan_out').round(2),
+            (pl.col('fan_out') > args.explain_fanout).alias('flagged')
+        )
+    )
+
+    t_elapsed = time.perf_counter() - t_start_explain
+    print(f'explain complete!: {t_elapsed:.2f}s')
+    print(f'join cardinality (sampling 1 in {explain_step()} left rows):')
+    with pl.Config(tbl_rows=-1, tbl_cols=-1, fmt_str_lengths=50):
+        print(report)
+    for join in report.filter(pl.col('flagged')).get_column('join'):
+        print(f'WARNING: {join} fan-out is over {args.explain_fanout}')
+
+
+def results_file_name(first_of_month: date, last_of_month: date) -> str:
+    """
+    build the file name for the results csv
+
+    args:
+        first_of_month: first date of the month in question
+        last_of_month: last date of the month in question
+
+    returns:
+        the file name, like `april2024_mandatory_use_full.csv`
+    """
+    start_month = calendar.month_name[first_of_month.month].lower()
+    end_month = calendar.month_name[last_of_month.month].lower()
+
+    if start_month == end_month:
+        return f'{start_month}{first_of_month.year}_mandatory_use_{'full' if not args.no_supplement else 'base'}.csv'
+    return f'{start_month}{first_of_month.year}-{end_month}{last_of_month.year}_mandatory_use_{'full' if not args.no_supplement else 'base'}.csv'
+
+
 def mu() -> None:
     """process the input files and write the output files"""
     t_start_mu = time.perf_counter()
 
     # for filtering searches to only the days we could potentially need
-    if args.no_auto_date:
-        first_of_month, last_of_month = args.first_written_date, args.last_written_date
-    else:
-        last_of_month = add_days(-1, datetime.now(tz=ZoneInfo(os.environ.get('TZ', 'UTC'))).replace(day=1).date())
-        first_of_month = last_of_month.replace(day=1)
+    first_of_month, last_of_month = written_dates()
 
     dispensations, searches, users, users_explode = prep_files(first_of_month, last_of_month)
 
-    final_dispensations, results = check_for_searches(dispensations, searches, users)
+    final_dispensations, results, matched_searches = check_for_searches(dispensations, searches, users)
+
+    period = period_label(first_of_month, last_of_month)
+    if args.detail:
+        write_search_detail(final_dispensations, matched_searches, period)
 
     results = add_counts(final_dispensations, results)
 
     if not args.no_supplement:
         results = supplement(final_dispensations, first_of_month, last_of_month, results, users_explode)
 
-    if args.testing:
-        results.write_csv('search_results.csv')
-        final_dispensations.collect(engine='streaming').write_csv('dispensations_results.csv')
+    if args.detail:
+        write_detail(results, 'results', period)
+        publish_detail(period)
 
     print('processing results and writing files...')
     t_start = time.perf_counter()
@@ -660,17 +1317,13 @@ def mu() -> None:
         .sort(['searches', 'dispensations'], descending=[False, True])
     )
 
-    start_month = calendar.month_name[first_of_month.month].lower()
-    end_month = calendar.month_name[last_of_month.month].lower()
-
-    if start_month == end_month:
-        result_file_name = f'{start_month}{first_of_month.year}_mandatory_use_{'full' if not args.no_supplement else 'base'}.csv'
-    else:
-        result_file_name = f'{start_month}{first_of_month.year}-{end_month}{last_of_month.year}_mandatory_use_{'full' if not args.no_supplement else 'base'}.csv'
-
+    result_file_name = results_file_name(first_of_month, last_of_month)
     results.write_csv(result_file_name)
     print(f'{result_file_name} saved')
 
+    if not args.no_history:
+        write_history(results, first_of_month, last_of_month)
+
     stats = (
         results
         .drop('rate')
@@ -696,7 +1349,8 @@ if __name__ == '__main__':
     parser.add_argument('-p', '--partial-ratio', type=float, default=0.5, help='patient name similarity ratio for partial search (default: %(default)s)')
     parser.add_argument('-d', '--days-before', type=int, default=7, help='max number of days before an rx was written to give credit for a search (default: %(default)s)')
     parser.add_argument('-nf', '--no-filter-vets', action='store_true', help='do not remove veterinarians from data')
-    parser.add_argument('-t', '--testing', action='store_true', help='save progress and detail files')
+    parser.add_argument('-dt', '--detail', action='store_true', help='save per prescriber detail files indexed by final_id')
+    parser.add_argument('-dd', '--detail-dir', type=str, default='detail', help='folder for the detail files (default: %(default)s) only used if using --detail')
     parser.add_argument('-ns', '--no-supplement', action='store_true', help='do not add additional information to the results')
     parser.add_argument('-o', '--overlap-ratio', type=float, default=0.9, help='patient name similarity for confirming overlap (default: %(default)s) only used if using --no-supplement')
     parser.add_argument('-ot', '--overlap-type', type=str, default='last', choices=['last', 'part', 'both'], help='type of overlap (default: %(default)s) only used if using --no-supplement')
@@ -707,10 +1361,31 @@ if __name__ == '__main__':
     parser.add_argument('-na', '--no-auto-date', action='store_true', help='pull data based on last month only used if using --tableau-api')
     parser.add_argument('-f', '--first-written-date', type=date.fromisoformat, default=date(2024, 4, 1), help='first written date in tableau in YYYY-MM-DD format (default: %(default)s) only used if --tableau-api --no-auto-date')
     parser.add_argument('-l', '--last-written-date', type=date.fromisoformat, default=date(2024, 4, 30), help='last written date in tableau in YYYY-MM-DD format (default: %(default)s) only used if --tableau-api --no-auto-date')
+    parser.add_argument('-x', '--explain', action='store_true', help='print optimized plans and estimated join sizes instead of running mu')
+    parser.add_argument('-xs', '--explain-sample', type=sample_fraction, default=0.1, help='fraction of left join rows sampled for join estimates (default: %(default)s) only used if using --explain')
+    parser.add_argument('-xf', '--explain-fanout', type=float, default=10.0, help='flag joins with more output rows per left row than this (default: %(default)s) only used if using --explain')
+    parser.add_argument('-nh', '--no-history', action='store_true', help='do not add the results to the history store')
+    parser.add_argument('-hd', '--history-dir', type=str, default='history', help='folder for the period partitioned history store (default: %(default)s)')
+    query = parser.add_mutually_exclusive_group()
+    query.add_argument('-qi', '--query-id', type=str, help='print the trend for a final_id across all stored periods instead of running mu')
+    query.add_argument('-qs', '--query-specialty', type=str, help='print the trend for a specialty (any level) across all stored periods instead of running mu')
+    query.add_argument('-ql', '--lookup-id', type=str, help='print the detail files for a final_id instead of running mu')
+    parser.add_argument('-lp', '--lookup-period', type=str, help='period to use for --lookup-id, like 2024-04 (default: most recently written)')
 
     args = parser.parse_args()
 
-    if args.tableau_api:
-        pull_files()
+    if args.explain and args.detail:
+        parser.error('--explain does not run mu, so it cannot be used with --detail')
+
+    if args.query_id or args.query_specialty:
+        query_history()
+    elif args.lookup_id:
+        lookup_detail()
+    else:
+        if args.tableau_api:
+            pull_files()
 
-    mu()
+        if args.explain:
+            explain()
+        else:
+            mu()